@@ -12,51 +12,288 @@ How to run:
     3. Verify data was written to `data/Litter_Index_Blocks_With_Coords.csv`
     4. Verify 'downloads' folder is poplulated with a bunch of images.
 """
-from threading import Thread
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from urllib.parse import urlencode
+import asyncio
+import json
 import time
 import os
-import random
-from PIL import Image
+import shutil
+import sqlite3
 
 import numpy as np
 import pandas as pd
-import googlemaps
-import google_streetview.api
+import aiohttp
+from turbojpeg import TurboJPEG, TJPF_RGB
 
 from api_key import google_api_key  # This is where the API Key lives
 
 LITTER_INDEX_FILE = "data//Litter_Index_Blocks.csv"
 FINAL_LITTER_INDEX_FILE = "data//Litter_Index_Blocks_With_Coords.csv"
-GMAPS = googlemaps.Client(key=google_api_key)
+GEOCODE_CACHE_FILE = "data//geocode_cache.sqlite"
+PIXEL_DATA_DIR = "data//pixel_data"
+LITTER_INDEX_DTYPES = {  # Compact dtypes for the litter index columns we use
+    'OBJECTID': 'int32',
+    'LR_HUNDRED_BLOCK': 'string',
+    'STREET_CLASS_NAME': 'category',
+    'SCORE_COLOR': 'category'
+}
+# Height, width and color channels of an image. This is also the size of the
+# images we download, so the pixel data always matches them
+IMAGE_SHAPE = (640, 640, 3)
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+PELIAS_URL = "http://localhost:4000/v1/search"
+STREETVIEW_URL = "https://maps.googleapis.com/maps/api/streetview"
+STREETVIEW_METADATA_URL = STREETVIEW_URL + "/metadata"
+
+# Create headings 0-270 (increments of 90 degrees)
+# NOTE: We will decrease the increments due to cost of extracting images
+HEADINGS = (0, 90, 180, 270)  # Direction TODO: We may want to experiment?
+
+# Parameters for street view API that are the same for every image
+STREETVIEW_PARAMS = {
+    'size': f'{IMAGE_SHAPE[1]}x{IMAGE_SHAPE[0]}',  # Width x height, max 640
+    'pitch': '-45',  # Orientation (up vs down)
+    'key': google_api_key  # API Key
+}
+
+# Geocodes are requested concurrently, since each request spends almost all of
+# its time waiting on the network. The cap keeps us under google's QPS limit.
+GEOCODE_CONCURRENCY = 10  # Max number of geocode requests in flight
+
+# Requests that fail for a temporary reason are retried, waiting longer after
+# every failed attempt (RETRY_BACKOFF seconds, then twice that, ...).
+MAX_RETRIES = 3  # Max number of times to retry a request
+RETRY_BACKOFF = 0.5  # Seconds to wait before the first retry
+
+# Which geocoder to use, 'google' or 'pelias'. For bulk runs a self-hosted
+# Pelias (https://github.com/pelias/docker) avoids google's billing and QPS
+# limit entirely.
+GEOCODER = 'google'
+
+# Geocodes are cached on disk so that re-running the script does not pay (in
+# both time and money) for addresses we have already looked up. They are kept
+# per geocoder, so switching GEOCODER does not reuse the other's results.
+GEOCODE_CACHE = sqlite3.connect(GEOCODE_CACHE_FILE)
+GEOCODE_CACHE.execute(
+    "CREATE TABLE IF NOT EXISTS cached_geocodes "
+    "(geocoder TEXT, address TEXT, geocode_json TEXT, "
+    "PRIMARY KEY (geocoder, address))")
+
+# Images for several locations are extracted at once, because there is network
+# latency when extracting the images through the google api. Images start as
+# soon as their geocode is done, through a queue of jobs.
+N_JOBS = os.cpu_count() * 2  # Number of locations to extract at once
+JOB_QUEUE_SIZE = 64  # Max number of jobs waiting on the queue
+
+# Decoding images to pixels is CPU bound rather than network bound, so it is
+# split across processes instead of threads to get around the GIL.
+N_PROCESSES = os.cpu_count()  # Number of Processes to run
+
+
+class GeocodeError(Exception):
+    """Raised when a geocoder could not find a geocode for an address."""
+
+
+class OverQueryLimitError(GeocodeError):
+    """Raised when the geocoder is over its query limit, worth retrying."""
+
+
+def randomize_addresses(addresses):
+    """Add a pseudo-random number between 30 and 70 to each house number.
+
+    The litter index only gives us the hundred block (i.e. 100 MAIN ST), so we
+    move somewhere into the block to get a more representative image. The
+    number added is taken from a hash of the address rather than drawn at
+    random, so the same block always maps to the same address and the geocode
+    cache keeps working across runs.
 
-# Threading is utilized to speed up the extraction of images.
-# Threading is the best choice here because there is network latency when
-# extracting the images through the google api.
-N_JOBS = os.cpu_count() * 2  # Number of Threads to run
-THREAD_QUEUE = []  # This will be our queue to manage our threads
+    Parameters
+    ----------
+    addresses : pd.Series
+        Addresses to randomize (i.e. 100 -> 160)
+    """
+    if addresses.empty:  # Nothing to split, the split would have no columns
+        return addresses.copy()
+
+    split_addresses = addresses.str.split(' ', n=1, expand=True)
+    hashes = pd.util.hash_pandas_object(addresses.astype(object), index=False)
+    numbers_to_add = ((hashes % 5 + 3) * 10).astype('int64')  # 30 to 70
+    house_numbers = split_addresses[0].astype('int64') + numbers_to_add
+
+    return house_numbers.astype(str) + " " + split_addresses[1]
+
+
+def read_cached_geocode(geocoder, address):
+    """Read the geocode of the given address from the geocode cache.
+
+    Returns None if the address has never been looked up with the geocoder.
+
+    Parameters
+    ----------
+    geocoder : String
+        Name of the geocoder (a key of GEOCODERS)
+    address : String
+        Exact address to search for geocode
+    """
+    row = GEOCODE_CACHE.execute(
+        "SELECT geocode_json FROM cached_geocodes "
+        "WHERE geocoder = ? AND address = ?",
+        (geocoder, address)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+def write_cached_geocode(geocoder, address, geocode):
+    """Write the geocode of the given address to the geocode cache.
+
+    Parameters
+    ----------
+    geocoder : String
+        Name of the geocoder (a key of GEOCODERS)
+    address : String
+        Exact address the geocode was searched for
+    geocode: dict
+        Dictionary of geocode results
+    """
+    with GEOCODE_CACHE:
+        GEOCODE_CACHE.execute(
+            "INSERT OR REPLACE INTO cached_geocodes VALUES (?, ?, ?)",
+            (geocoder, address, json.dumps(geocode)))
+
+
+async def geocode_one_google(session, semaphore, address):
+    """Search for geocode of given address through the google api.
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+        Session to send the request through
+    semaphore : asyncio.Semaphore
+        Limits the number of requests in flight at once
+    address : String
+        Exact address to search for geocode
+    """
+    params = {'address': address, 'key': google_api_key}
+    async with semaphore, session.get(GEOCODE_URL, params=params) as response:
+        response.raise_for_status()
+        geocode_result = await response.json()
+
+    # Google answers with a 200 even when the search failed, so check the
+    # status. Going over the QPS limit is temporary, so it gets retried
+    if geocode_result['status'] == 'OVER_QUERY_LIMIT':
+        raise OverQueryLimitError(f"Geocoding {address} went over the limit")
+    if geocode_result['status'] != 'OK':
+        raise GeocodeError(
+            f"Geocoding {address} failed with status "
+            f"{geocode_result['status']}: "
+            f"{geocode_result.get('error_message', 'no results')}")
+    return geocode_result['results'][0]
+
+
+async def geocode_one_pelias(session, semaphore, address):
+    """Search for geocode of given address through a self-hosted Pelias.
+
+    Pelias returns GeoJSON, so the result is reshaped into the parts of a
+    google geocode that we use. This way the rest of the code does not need to
+    know which geocoder was used.
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+        Session to send the request through
+    semaphore : asyncio.Semaphore
+        Limits the number of requests in flight at once
+    address : String
+        Exact address to search for geocode
+    """
+    params = {'text': address, 'size': 1}
+    async with semaphore, session.get(PELIAS_URL, params=params) as response:
+        response.raise_for_status()
+        geocode_result = await response.json()
+    if not geocode_result.get('features'):
+        raise GeocodeError(f"Geocoding {address} failed: no results")
+    feature = geocode_result['features'][0]
+    lng, lat = feature['geometry']['coordinates']
+    return {
+        'formatted_address': feature['properties']['label'],
+        'geometry': {'location': {'lat': lat, 'lng': lng}}
+    }
 
 
-def extract_geocode(address):
+# Geocoders we can search with, chosen by GEOCODER
+GEOCODERS = {
+    'google': geocode_one_google,
+    'pelias': geocode_one_pelias
+}
+
+
+async def extract_geocode(session, semaphore, address):
     """Search for geocode of given address.
 
     This function will return the geocode of the given address. A geocode has
     a lot of information attatched to it including longitude and latitude
     coordinates. We will worry about cleaning up the geocode later.
 
+    The geocode cache is checked first. Only if the address has never been
+    looked up before is it sent to GEOCODER, and the result is then stored in
+    the cache for future runs.
+
     Parameters
     ----------
+    session : aiohttp.ClientSession
+        Session to send the request through
+    semaphore : asyncio.Semaphore
+        Limits the number of requests in flight at once
     address : String
-        Address to search for geocode
+        Exact address to search for geocode
+    """
+    geocode = read_cached_geocode(GEOCODER, address)
+    if geocode is None:
+        geocode = await with_retries(
+            GEOCODERS[GEOCODER], session, semaphore, address)
+        write_cached_geocode(GEOCODER, address, geocode)
+    return geocode
+
+
+def is_transient(error):
+    """Check whether a failed request is worth retrying.
+
+    Connection problems, timeouts, rate limiting (including google's
+    OVER_QUERY_LIMIT) and server errors usually go away on their own, anything
+    else (i.e. a bad API key) will not.
+
+    Parameters
+    ----------
+    error : Exception
+        Error raised by the request
     """
-    # Add a random number between 30 and 70 to address (i.e. 100 -> 160)
-    split_address = address.split(' ')
-    number_to_add = random.randrange(30, 80, 10)  # Rand num between 30 and 70
-    house_number = int(split_address[0]) + number_to_add  # Add num to address
-    new_address = str(house_number) + " " + " ".join(split_address[1:])
-    print(new_address)
+    if isinstance(error, OverQueryLimitError):
+        return True
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
 
-    geocode_result = GMAPS.geocode(new_address)
-    return geocode_result[0]
+async def with_retries(request, *args):
+    """Run a request, retrying it with backoff if it fails temporarily.
+
+    Parameters
+    ----------
+    request : Coroutine function
+        Request to run
+    *args
+        Arguments to run the request with
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await request(*args)
+        except Exception as error:
+            if attempt == MAX_RETRIES or not is_transient(error):
+                raise
+        await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
 
 
 def extract_lat(geocode):
@@ -85,28 +322,136 @@ def extract_lng(geocode):
     return geocode['geometry']['location']['lng']
 
 
-def extract_all_geocodes(data):
+async def produce_jobs(session, semaphore, queue, address, object_ids):
+    """Extract the geocode of an address and queue up its images.
+
+    A job here is just a set of kwargs that will be passed into the
+    extract_image function, one for every OBJECTID on the street. Returns the
+    geocode, or None if the address could not be geocoded (its images are
+    then skipped, and the address is tried again on the next run).
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+        Session to send the requests through
+    semaphore : asyncio.Semaphore
+        Limits the number of geocode requests in flight at once
+    queue : asyncio.Queue
+        Queue to put our jobs on
+    address : String
+        Exact address to search for geocode
+    object_ids : List
+        OBJECTIDs of every data point with this address
+    """
+    try:
+        geocode = await extract_geocode(session, semaphore, address)
+    except Exception as error:
+        print(f"Failed to extract geocode for {address}: {error!r}")
+        return None
+
+    for object_id in object_ids:
+        await queue.put({
+            'lat': extract_lat(geocode),
+            'lng': extract_lng(geocode),
+            'folder_name': object_id
+        })
+    return geocode
+
+
+async def extract_all_geocodes(session, queue, data):
     """Extract longitude and latitude coordinates for street locations.
 
     This method will extract all coordinates for every street address in our
-    CSV file containing our Litter Indexes.
-    """
-    # Apply coordinates extractor to every row
-    data['geocode_result'] = data.apply(lambda row: extract_geocode(
-                    row['LR_HUNDRED_BLOCK'] + ", Philidelphia, PA"), axis=1)
+    CSV file containing our Litter Indexes, queuing up the images of each
+    address as soon as its geocode comes back.
 
-    # Extract latitude
-    data['lat'] = data.apply(lambda row: extract_lat(
-                    row['geocode_result']), axis=1)
+    Once every geocode is done, the coordinates are added to `data` and saved
+    to FINAL_LITTER_INDEX_FILE, and a None is put on the queue for every
+    consumer to let it know there are no more jobs coming.
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+        Session to send the requests through
+    queue : asyncio.Queue
+        Queue to put our jobs on
+    data : pd.DataFrame
+        Litter Indexes to extract coordinates for
+    """
+    # Extract geocode once per unique street address, then map it back to
+    # every row with that address
+    blocks = data['LR_HUNDRED_BLOCK'].drop_duplicates()
+    addresses = randomize_addresses(blocks.astype('string'))
+    addresses = addresses + ", Philidelphia, PA"
+    object_ids = {}
+    for block, object_id in zip(data['LR_HUNDRED_BLOCK'], data['OBJECTID']):
+        object_ids.setdefault(block, []).append(object_id)
+
+    semaphore = asyncio.Semaphore(GEOCODE_CONCURRENCY)
+    geocodes = await asyncio.gather(
+        *[produce_jobs(session, semaphore, queue, address, object_ids[block])
+          for block, address in zip(blocks, addresses)])
+
+    geocodes = pd.Series(geocodes, index=blocks.to_numpy(), dtype=object)
+    data['geocode_result'] = data['LR_HUNDRED_BLOCK'].map(geocodes)
+
+    # Extract latitude, addresses we could not geocode are left empty
+    data['lat'] = data['geocode_result'].map(extract_lat, na_action='ignore')
 
     # Extract longitude
-    data['lng'] = data.apply(lambda row: extract_lng(
-                    row['geocode_result']), axis=1)
+    data['lng'] = data['geocode_result'].map(extract_lng, na_action='ignore')
+
+    data.to_csv(FINAL_LITTER_INDEX_FILE)
+
+    for _ in range(N_JOBS):
+        await queue.put(None)
+
+
+async def consume_jobs(session, queue):
+    """Extract images for the jobs on the queue until we are handed a None.
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+        Session to send the requests through
+    queue : asyncio.Queue
+        Queue to take our jobs from
+    """
+    while True:
+        job = await queue.get()
+        if job is None:
+            return
+        # A single location failing should not stop the rest of them. Its
+        # folder is not saved, so it is tried again on the next run
+        try:
+            await extract_image(session, **job)
+        except Exception as error:
+            print(f"Failed to extract images for {job['folder_name']}: "
+                  f"{error!r}")
+
+
+async def extract_all_geocodes_and_images(data):
+    """Extract coordinates and images for street locations.
+
+    This method will extract all coordinates for every street address in our
+    CSV file containing our Litter Indexes, along with the images for those
+    coordinates.
+
+    Rather than waiting for every geocode before extracting any images, the
+    two overlap: as soon as the geocode of an address comes back, its images
+    are queued up and picked up by one of N_JOBS consumers. The queue is
+    bounded so that geocoding can not run too far ahead of the images.
+    """
+    queue = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(
+            extract_all_geocodes(session, queue, data),
+            *[consume_jobs(session, queue) for _ in range(N_JOBS)])
 
     return data
 
 
-def extract_image(lat, lng, folder_name):
+async def extract_image(session, lat, lng, folder_name, headings=HEADINGS):
     """Extract image for given latitude and longitude coordinate.
 
     Uses the google street view API to an extract an image from a specified
@@ -118,79 +463,216 @@ def extract_image(lat, lng, folder_name):
 
     Parameters
     ----------
+    session : aiohttp.ClientSession
+        Session to send the requests through
     lat : String
         Latitude of interest
     lng : String
         Longitude of interest
     folder_name : String
         Location to save our files
+    headings : Tuple
+        Directions to extract an image for (one image per heading)
     """
     folder_path = f'image_downloads/{folder_name}'
-
-    # Create headings 0-270 (increments of 90 degrees)
-    # NOTE: We will decrease the increments due to cost of extracting images
-    headings = [x for x in range(0, 360, 90)]
+    # Download to a temporary folder first, it is only moved into place once
+    # everything is saved. This way a failed download never looks completed
+    download_path = folder_path + '.tmp'
+    shutil.rmtree(download_path, ignore_errors=True)  # Left from a crash
 
     # Define parameters for street view API
     # Will create a list of params for each heading
-    params = [{
-        'size': '640x640',  # Max 640x640 pixels
-        'location': f'{lat},{lng}',  # Coordinates
-        'heading': heading,  # Direction TODO: We may want to experiment?
-        'pitch': '-45',  # Orientation (up vs down)
-        'key': google_api_key  # API Key
-    } for heading in headings]
-
-    # Create a results object
-    results = google_streetview.api.results(params)
+    location = f'{lat},{lng}'  # Coordinates
+    params = [dict(STREETVIEW_PARAMS, location=location, heading=heading)
+              for heading in headings]
 
     # Download images to directory 'downloads'
     print(f"Saving image to {folder_path}")
-    results.download_links(folder_path)
+    os.makedirs(download_path)
+    try:
+        metadata = await download_images(session, params, download_path)
+
+        # Save metadata with file reference
+        with open(f'{download_path}/metadata.json', 'w') as f:
+            json.dump(metadata, f)
+
+        # Save links - Won't need to use, but nice to have
+        with open(f'{download_path}/links.txt', 'w') as f:
+            f.write('\n'.join(
+                f'{STREETVIEW_URL}?{urlencode(param)}' for param in params))
+    except BaseException:
+        shutil.rmtree(download_path, ignore_errors=True)
+        raise
+
+    os.replace(download_path, folder_path)
+
+
+def list_images(folder_name):
+    """List the images downloaded for a location, in a consistent order.
+
+    Parameters
+    ----------
+    folder_name : String
+        Location of our files (the OBJECTID)
+    """
+    return sorted(
+        image for image in os.listdir(f'image_downloads/{folder_name}')
+        if image.endswith('.jpg'))
+
+
+@lru_cache(maxsize=None)
+def get_turbo_jpeg():
+    """Load libjpeg-turbo, once per process.
+
+    libjpeg-turbo decodes with SIMD and can write into an existing array, which
+    saves allocating (and copying out of) a new image for every decode. It is
+    only loaded once we decode, so that the rest of the script runs without it.
+    """
+    return TurboJPEG()
+
+
+def extract_pixel_data(pixels_file, folder_name, offset):
+    """Extract pixel values for every image downloaded for a location.
+
+    The pixels of every image in the folder are written straight into the
+    memory-mapped pixel data file, starting at row `offset`. Every folder
+    writes to its own rows, so this can safely be run in separate processes.
+
+    Parameters
+    ----------
+    pixels_file : String
+        Pixel data file to write to
+    folder_name : String
+        Location of our files (the OBJECTID)
+    offset : int
+        Row of the pixel data file to write the first image to
+    """
+    folder_path = f'image_downloads/{folder_name}'
+    pixels = np.load(pixels_file, mmap_mode='r+')
 
-    # Save links - Won't need to use, but nice to have
-    results.save_links(f'{folder_path}/links.txt')
+    for i, image in enumerate(list_images(folder_name), start=offset):
+        with open(folder_path + "/" + image, 'rb') as f:  # Load image
+            # Decode pixels (in the correct color channel) directly into row i.
+            # PyTurboJPEG only decodes into dst if it is a plain np.ndarray
+            # (not an np.memmap), so we hand it a plain view of the row
+            row = np.asarray(pixels[i])
+            decoded = get_turbo_jpeg().decode(
+                f.read(), pixel_format=TJPF_RGB, dst=row)
 
-    # Convert to image to pixel value & save
-    data = []
-    for image in os.listdir(folder_path):
-        if image.endswith('.jpg'):
-            im = Image.open(folder_path + "/" + image)  # Load image
-            # Clean image
-            img = im.convert('RGB')  # Ensures correct color channel
-            # img_resize = img_cs.resize(640, 640)  # Ensures correct size
-            img_array = np.asarray(img)  # Extracts pixels
-            # Append objectID to file
-            img_array = np.append(img_array, int(folder_name))
-            data.append(img_array)
+        # Otherwise the image was decoded into a new array (i.e. it is not the
+        # size of IMAGE_SHAPE) and the row would silently stay empty
+        if decoded is not row:
+            raise ValueError(
+                f"{folder_path}/{image} has shape {decoded.shape}, "
+                f"expected {IMAGE_SHAPE}")
 
-    # Save and reshape data
-    data_array = np.array(data)
-    data_array = data_array.reshape(4, 640 * 640 * 3 + 1)  # Plus one for label
+    pixels.flush()
 
-    # Append data_array to data file
-    with open('data/pixel_data', 'ab') as f:
-        np.savetxt(f, data_array, delimiter=",", fmt='%f')
 
-    # To Load run: arr = np.loadtxt('data/pixel_data', delimiter=",")
+def extract_all_pixel_data(object_ids):
+    """Extract pixel values for the images downloaded for the given OBJECTIDs.
 
+    Every run writes its own pair of files to 'data/pixel_data', named after
+    the time of the run: `pixels_<time>.npy` with the images and
+    `object_ids_<time>.npy` with the OBJECTID of every image. The pixel file
+    is sized up front and each folder is then decoded in its own process,
+    writing directly into its slice of the file. The files are built under a
+    temporary name and only moved into place once every folder is done.
 
-def extract_images_worker():
-    """Thread worker for extracting images.
+    To Load run: arr = np.load('data/pixel_data/pixels_<time>.npy',
+                               mmap_mode='r')
 
-    This function serves as a thread worker. This means that a single thread
-    will be running this function. This function will check to see if the
-    THREAD_QUEUE is empty or not empty. If it is not empty, the thread will
-    then utilize its resource to complete this job for the particular image.
+    Parameters
+    ----------
+    object_ids : List
+        OBJECTIDs to extract pixel data for, ones without images are skipped
+    """
+    folders = [str(object_id) for object_id in object_ids
+               if os.path.isdir(f'image_downloads/{object_id}')]
+    counts = [len(list_images(folder)) for folder in folders]
+    offsets = np.cumsum([0] + counts[:-1]).tolist()
+    if sum(counts) == 0:
+        return
+
+    os.makedirs(PIXEL_DATA_DIR, exist_ok=True)
+    run_time = time.strftime('%Y%m%d%H%M%S')
+    pixels_file = f'{PIXEL_DATA_DIR}/pixels_{run_time}.npy'
+    object_ids_file = f'{PIXEL_DATA_DIR}/object_ids_{run_time}.npy'
+
+    # Create the files, the header is written right away so that the worker
+    # processes can open them
+    pixels = np.lib.format.open_memmap(
+        pixels_file + '.tmp', mode='w+', dtype=np.uint8,
+        shape=(sum(counts),) + IMAGE_SHAPE)
+    del pixels
+    object_ids = np.lib.format.open_memmap(
+        object_ids_file + '.tmp', mode='w+', dtype=np.int32,
+        shape=(sum(counts),))
+    object_ids[:] = np.repeat([int(folder) for folder in folders], counts)
+    object_ids.flush()
+    del object_ids
+
+    with ProcessPoolExecutor(max_workers=N_PROCESSES) as executor:
+        futures = [
+            executor.submit(
+                extract_pixel_data, pixels_file + '.tmp', folder, offset)
+            for folder, offset in zip(folders, offsets)]
+        for future in as_completed(futures):
+            future.result()
+
+    os.replace(pixels_file + '.tmp', pixels_file)
+    os.replace(object_ids_file + '.tmp', object_ids_file)
+
+
+async def download_image(session, params, file_path):
+    """Download a single street view image.
+
+    The (free) metadata endpoint is checked first so that we only download
+    images for locations google actually has imagery for. Returns the metadata.
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+        Session to send the requests through
+    params : dict
+        Parameters for street view API
+    file_path : String
+        Location to save the image
+    """
+    async with session.get(STREETVIEW_METADATA_URL, params=params) as response:
+        response.raise_for_status()
+        metadata = await response.json()
+    if metadata['status'] != 'OK':
+        return metadata
 
-    The idea behind this stems from the Producer and Consumer problem.
+    metadata['_file'] = os.path.basename(file_path)  # Add file reference
+    async with session.get(STREETVIEW_URL, params=params) as response:
+        response.raise_for_status()
+        with open(file_path, 'wb') as f:
+            async for chunk in response.content.iter_chunked(65536):
+                f.write(chunk)
+    return metadata
+
+
+async def download_images(session, params, folder_path):
+    """Download the street view images for all given params concurrently.
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+        Session to send the requests through
+    params : List
+        Parameters for street view API, one per image
+    folder_path : String
+        Location to save our files
     """
-    while len(THREAD_QUEUE) > 0:
-        kwargs = THREAD_QUEUE.pop()
-        extract_image(**kwargs)
+    return await asyncio.gather(
+        *[with_retries(download_image, session, param,
+                       f'{folder_path}/gsv_{i}.jpg')
+          for i, param in enumerate(params)])
 
 
-def get_data(street_class_names, score_colors):
+def get_data(street_class_names, score_colors, limit=None):
     """Extract data to query on.
 
     Extracts data to extract geocodes and images for. Basic data cleaning and
@@ -202,9 +684,11 @@ def get_data(street_class_names, score_colors):
         Defines which street class name we want to keep.
     score_colors: List
         Defines which scores colors we want to keep.
+    limit: int
+        Max number of data points to keep, or None to keep all of them.
     """
-    # Read CSV
-    data = pd.read_csv(LITTER_INDEX_FILE)
+    # Read CSV, every column is kept since they are all written back out
+    data = pd.read_csv(LITTER_INDEX_FILE, dtype=LITTER_INDEX_DTYPES)
 
     # Grab streetnames whose numbers are decimal
     data = data[
@@ -220,13 +704,15 @@ def get_data(street_class_names, score_colors):
     # Drop duplicate street names
     data = data.drop_duplicates('LR_HUNDRED_BLOCK')
     
-    if 'image_downloads' in os.listdir():
+    if os.path.isdir('image_downloads'):
         # Remove OBJECTIDs we already completed
-        data = data[
-            ~data['OBJECTID'].astype(str).isin(os.listdir('image_downloads'))]
+        with os.scandir('image_downloads') as entries:
+            completed = frozenset(
+                entry.name for entry in entries if entry.is_dir())
+        data = data[~data['OBJECTID'].astype(str).isin(completed)]
 
-    # Truncating data for now because of cost... Serves as testing for now
-    data = data.iloc[:1]
+    if limit is not None:
+        data = data.iloc[:limit]
 
     return data
 
@@ -236,44 +722,20 @@ if __name__ == '__main__':
     # Extract data given our conversations
     data_requirements_kwargs = {
         'street_class_names': ['Local'],
-        'score_colors': ['MAROON']
+        'score_colors': ['MAROON'],
+        # Truncating data for now because of cost... Serves as testing for now
+        'limit': 1
     }
     data = get_data(**data_requirements_kwargs)
 
     start_time = time.time()
-    print("Begin extracting coordinates.")
-    data_and_geocode = extract_all_geocodes(data)
-    data_and_geocode.to_csv(FINAL_LITTER_INDEX_FILE)
-    print("Done extracting coordinates.")
-
-    print("\nBegin extracting images.")
-    for idx, row in data_and_geocode.iterrows():
-        lat = row['lat']
-        lng = row['lng']
-        object_id = row['OBJECTID']
-
-        # Add "jobs" to our queue. A job here is just a set of kwargs that will
-        # be passed into the extract_image function
-        THREAD_QUEUE.append(
-            {
-                'lat': lat,
-                'lng': lng,
-                'folder_name': object_id
-            }
-        )
-
-    # Begin threading for multiple jobs
-    image_threads = []
-    for i in range((N_JOBS)):
-        t = Thread(target=extract_images_worker)
-        t.start()
-        image_threads.append(t)
-
-    # Join threads back together
-    for t in image_threads:
-        t.join()
-
-    print("Done extracting images.")
+    print("Begin extracting coordinates and images.")
+    data_and_geocode = asyncio.run(extract_all_geocodes_and_images(data))
+    print("Done extracting coordinates and images.")
+
+    print("\nBegin extracting pixel data.")
+    extract_all_pixel_data(data_and_geocode['OBJECTID'].tolist())
+    print("Done extracting pixel data.")
 
     # Display total execution time
     total_time = round(time.time() - start_time, 2)